@@ -1,8 +1,13 @@
+import functools
+import io
+import os
 import pandas as pd
 import numpy as np
-import re
 
-def load_file(path, header=[]):
+# Leading bytes of the numeric rows (and blank lines) in a HEKA .asc export
+DATA_ROW_START = np.frombuffer(b" \t\r\n0123456789+-.", dtype=np.uint8)
+
+def load_file(path, header=[], dtype=np.float32):
     """
     This function will parse a standard HEKA .asc file into a pandas dataframe.
 
@@ -13,6 +18,9 @@ def load_file(path, header=[]):
     
     headers : list
         A list or iterable of string column headers. The list of headers must match the number of columns in the dataframe.
+
+    dtype : type
+        The numeric type of every data column after the leading index column, which is read as int32. Defaults to float32.
         
     Returns
     ---------
@@ -20,33 +28,45 @@ def load_file(path, header=[]):
         The file reformatted into a dataframe with the given headers.
     """
 
-    lineIndices = []            
-    
-    # Splits string at \n and removes trailing spaces  
-    with open(path, "r") as f:                        
-        rawFile = f.read().strip().split("\n")         
-
-    count=0          
-    # Finds rows that contain header information to exclude from df                                     
-    for line in rawFile:                                  
-        if re.search(r"[a-z]+", line) == None:           
-            lineIndices.append(count)                     
-        count += 1                                    
-    
-    # Formats headerless file for later df
-    processedFile = [rawFile[i].strip().replace(" ", "").split(",") for i in lineIndices]     
+    # Parsed files are cached until modified; hand out a copy so in-place edits never reach the cache
+    df = _read_asc(path, os.path.getmtime(path), tuple(header), dtype)
+
+    return df.copy()
+
+@functools.lru_cache(maxsize=4)
+def _read_asc(path, mtime, header, dtype):
+    """
+    This function does the parsing for ``load_file``. The modification time ``mtime`` is only used as part of the cache key.
+    """
 
-    # Use the difference in file with and without headers to find nSweeps
-    nSweeps = int((len(rawFile)-len(processedFile)-1)/2)   
+    with open(path, "rb") as f:
+        rawFile = f.read()
 
-    if len(processedFile[0]) != len(header):
+    # Classify every line by its first byte in a single vectorized pass
+    buffer = np.frombuffer(rawFile, dtype=np.uint8)
+    lineStarts = np.concatenate(([0], np.flatnonzero(buffer == ord("\n")) + 1))
+    lineStarts = lineStarts[lineStarts < len(buffer)]
+    headerRows = np.flatnonzero(~np.isin(buffer[lineStarts], DATA_ROW_START))
+
+    # Use the number of header lines to find nSweeps
+    nSweeps = int((len(headerRows) - 1)/2)
+
+    # Let the C parser read the numeric rows directly into their final dtypes, skipping the header lines
+    dtypes = dict.fromkeys(range(1, len(header)), dtype)
+    dtypes[0] = np.int32
+    df = pd.read_csv(io.BytesIO(rawFile), header=None, skiprows=headerRows, skipinitialspace=True, dtype=dtypes, engine='c')
+
+    if df.shape[1] != len(header):
         raise Exception("Header length must match number of columns in dataframe")
-        
-    df = pd.DataFrame(data=processedFile, columns=header)
-    df = df.apply(pd.to_numeric)
-    df = df.dropna(axis=0)
 
-    # Make new column with sweep identity
-    df['sweep'] = np.repeat(np.arange(nSweeps) + 1, len(df)/nSweeps)
+    df.columns = list(header)
+
+    samplesPerSweep, remainder = divmod(len(df), nSweeps)
+
+    if remainder != 0:
+        raise Exception("Number of data rows must be the same for every sweep")
+
+    # Make new column with sweep identity, stored as ordered codes so grouping by sweep skips hashing
+    df['sweep'] = pd.Categorical.from_codes(np.repeat(np.arange(nSweeps, dtype=np.int16), samplesPerSweep), categories=np.arange(1, nSweeps + 1), ordered=True)
     
-    return df
\ No newline at end of file
+    return df
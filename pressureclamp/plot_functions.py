@@ -1,11 +1,22 @@
-import cufflinks as cf
-from plotly.subplots import make_subplots
-import plotly.graph_objs as go
-import plotly.express as px
 import numpy as np
-from scipy.optimize import curve_fit
-from scipy.stats import iqr
-from scipy.stats import norm
+from .preprocess import sweep_offsets
+
+SQRT_2PI = np.sqrt(2 * np.pi)
+
+_compiledKernels = {}
+
+def _compiled(func):
+    """
+    This function returns ``func`` compiled with numba, importing and compiling it on first use so importing the package stays light. Without numba the kernel runs as plain NumPy.
+    """
+    if func not in _compiledKernels:
+        try:
+            from numba import njit
+            _compiledKernels[func] = njit(cache=True, fastmath=True)(func)
+        except ImportError:
+            _compiledKernels[func] = func
+
+    return _compiledKernels[func]
 
 def sigmoid_fit(p, p50, k):
     """
@@ -25,7 +36,39 @@ def sigmoid_fit(p, p50, k):
     series
         The ordinate for a boltzmann sigmoid with the passed parameters.
     """
-    return(1 / (1 + np.exp((p50 - p) / k)))
+    # Evaluate in a single buffer to avoid a temporary per operation
+    sig = np.array(p, dtype=float)
+    np.subtract(p50, sig, out=sig)
+    sig *= 1 / k
+    np.exp(sig, out=sig)
+    sig += 1
+
+    return(np.reciprocal(sig, out=sig))
+
+def sigmoid_jac(p, p50, k):
+    """
+    This function defines the analytical jacobian of ``sigmoid_fit`` for use with ``curve_fit``.
+
+    Arguments
+    ------------------- 
+    p: series 
+        The abscissa data.
+    p50: float
+        The inflection point of the sigmoid.
+    k: float
+        The slope at the inflection point of a sigmoid.
+    
+    Returns
+    --------------------
+    array
+        An array with one row per abscissa value and columns for the partial derivatives with respect to ``p50`` and ``k``.
+    """
+    # Written in terms of the sigmoid value so steep slopes cannot overflow to inf/inf
+    diff = p50 - np.asarray(p, dtype=float)
+    f = sigmoid_fit(p, p50, k)
+    slope = f * (1 - f) / k
+
+    return(np.stack([-slope, slope * diff / k], axis=-1))
     
 def single_gauss_fit(x, a1, m1, s1):
     """
@@ -47,10 +90,62 @@ def single_gauss_fit(x, a1, m1, s1):
     series
         The ordinate for a gaussian curve described by the input parameters.
     """
-    gauss = a1 * norm.pdf(x, loc = m1, scale = s1)
+    z = (x - m1) / s1
+    gauss = a1 * np.exp(-0.5 * z * z) / (s1 * SQRT_2PI)
 
     return gauss
 
+def gauss_sum(x, a, m, s):
+    """
+    This function defines a sum of gaussian curves evaluated in a single broadcast pass. The fit models run it compiled with numba when available.
+
+    Arguments
+    ------------------- 
+    x: array 
+        A contiguous float64 array of the abscissa data.
+    a: array
+        The amplitudes of the gaussians.
+    m: array
+        The midpoints of the gaussians.
+    s: array
+        The standard deviations of the gaussians.
+    
+    Returns
+    --------------------
+    array
+        The ordinate for the sum of the gaussian curves described by the input parameters.
+    """
+    z = (x.reshape(-1, 1) - m) / s
+    gauss = (np.exp(-0.5 * z * z) * (a / (s * SQRT_2PI))).sum(axis=1)
+
+    return gauss
+
+def gauss_sum_jac(x, a, m, s):
+    """
+    This function defines the analytical jacobian of ``gauss_sum``. The fit models run it compiled with numba when available.
+
+    Arguments
+    ------------------- 
+    x: array 
+        A contiguous float64 array of the abscissa data.
+    a: array
+        The amplitudes of the gaussians.
+    m: array
+        The midpoints of the gaussians.
+    s: array
+        The standard deviations of the gaussians.
+    
+    Returns
+    --------------------
+    array
+        An array with one row per abscissa value and columns for the partial derivatives with respect to every amplitude, then every midpoint, then every standard deviation.
+    """
+    z = (x.reshape(-1, 1) - m) / s
+    phi = np.exp(-0.5 * z * z) / (s * SQRT_2PI)
+    jac = np.concatenate((phi, a * phi * z / s, a * phi * (z * z - 1) / s), axis=1)
+
+    return jac
+
 def double_gauss_fit(x, a1, a2, m1, m2, s1, s2):
     """
     This function defines a double gaussian curve.
@@ -78,11 +173,18 @@ def double_gauss_fit(x, a1, a2, m1, m2, s1, s2):
         The ordinate for a pair of gaussian curve described by the input parameters.
     """
     
-    gauss = a1 * norm.pdf(x, loc = m1, scale = s1)
-    gauss += a2 * norm.pdf(x, loc = m2, scale = s2)
+    gauss = _compiled(gauss_sum)(np.ascontiguousarray(x, dtype=np.float64), np.array([a1, a2]), np.array([m1, m2]), np.array([s1, s2]))
 
     return gauss
 
+def double_gauss_jac(x, a1, a2, m1, m2, s1, s2):
+    """
+    This function defines the analytical jacobian of ``double_gauss_fit`` for use with ``curve_fit``. The arguments are the same as for ``double_gauss_fit``.
+    """
+    jac = _compiled(gauss_sum_jac)(np.ascontiguousarray(x, dtype=np.float64), np.array([a1, a2]), np.array([m1, m2]), np.array([s1, s2]))
+
+    return jac
+
 def triple_gauss_fit(x, a1, a2, a3, m1, m2, m3, s1, s2, s3):
     """
     This function defines a double gaussian curve.
@@ -115,40 +217,89 @@ def triple_gauss_fit(x, a1, a2, a3, m1, m2, m3, s1, s2, s3):
     series
         The ordinate for three gaussian curves described by the input parameters.
     """
-    gauss = a1 * norm.pdf(x, loc = m1, scale = s1)
-    gauss += a2 * norm.pdf(x, loc = m2, scale = s2)
-    gauss += a3 * norm.pdf(x, loc = m3, scale = s3)
+    gauss = _compiled(gauss_sum)(np.ascontiguousarray(x, dtype=np.float64), np.array([a1, a2, a3]), np.array([m1, m2, m3]), np.array([s1, s2, s3]))
 
     return gauss
 
-def ngauss_guesses(x, y, nGauss):
+def triple_gauss_jac(x, a1, a2, a3, m1, m2, m3, s1, s2, s3):
+    """
+    This function defines the analytical jacobian of ``triple_gauss_fit`` for use with ``curve_fit``. The arguments are the same as for ``triple_gauss_fit``.
+    """
+    jac = _compiled(gauss_sum_jac)(np.ascontiguousarray(x, dtype=np.float64), np.array([a1, a2, a3]), np.array([m1, m2, m3]), np.array([s1, s2, s3]))
+
+    return jac
+
+def ngauss_guesses(x, y, nGauss, nIter=25):
     """
-    This function will generate initial guesses for a gaussian fit to single-channel data.
+    This function will generate initial guesses for a gaussian fit to single-channel data. The histogram is split into ``nGauss`` clusters by a weighted one-dimensional k-means and the weight, mean and standard deviation of each cluster seed the fit.
 
     Arguments
     ------------------- 
     x: list 
-        A list of histogram bins.
+        A list of histogram bin edges.
     y: list
         A list of histogram weights.
     nGauss: int
         The number of gaussians estimated to represent the data.
+    nIter: int
+        The maximum number of k-means iterations. Defaults to 25.
     
     Returns
     --------------------
     test: list
-        A list of parameter estimates for the gaussian fits.
+        A list of parameter estimates for the gaussian fits, with the gaussians ordered by decreasing mean.
     """
-    initial_guesses = {"p":[1], "u": [x[np.argmax(y)]], "s": [0.5]}
-    for i in list(range(0, nGauss - 1)):
-        initial_guesses["p"].append(0.5 * initial_guesses["p"][i])
-        initial_guesses["u"].append(-2.2 * (i+1) + initial_guesses["u"][i])
-        initial_guesses["s"].append(2 * initial_guesses["s"][i])
+    x = np.asarray(x, dtype=float)
+    weights = np.asarray(y, dtype=float)
+    centers = 0.5 * (x[:-1] + x[1:]) if len(x) == len(weights) + 1 else x
+    weights = weights / weights.sum()
 
-    arr = [np.array(initial_guesses['p']), np.array(initial_guesses['u']), np.array(initial_guesses['s'])]
+    # Seed the means at evenly spaced quantiles of the histogram
+    means = np.interp((np.arange(nGauss) + 0.5) / nGauss, np.cumsum(weights), centers)
+
+    for i in range(nIter):
+        labels = np.argmin(np.abs(centers[:, None] - means), axis=1)
+        mass = np.bincount(labels, weights=weights, minlength=nGauss)
+        sums = np.bincount(labels, weights=weights * centers, minlength=nGauss)
+        newMeans = np.where(mass > 0, sums / np.where(mass > 0, mass, 1), means)
+
+        if np.allclose(newMeans, means):
+            break
+        means = newMeans
+
+    labels = np.argmin(np.abs(centers[:, None] - means), axis=1)
+    mass = np.bincount(labels, weights=weights, minlength=nGauss)
+    sqDev = np.bincount(labels, weights=weights * (centers - means[labels])**2, minlength=nGauss)
+
+    # Keep every width at least one bin wide so empty or single-bin clusters stay fittable
+    binWidth = np.abs(centers[1] - centers[0]) if len(centers) > 1 else 1.0
+    stdevs = np.maximum(np.sqrt(sqDev / np.where(mass > 0, mass, 1)), binWidth)
+
+    order = np.argsort(means)[::-1]
+    arr = [mass[order], means[order], stdevs[order]]
 
     return(arr)
 
+def join_sweeps(df, *cols):
+    """
+    This function will join all sweeps of a dataframe into single arrays with NaN breaks between sweeps.
+
+    Arguments
+    --------------
+    df: dataframe
+        A dataframe with a ``sweep`` column in which each sweep occupies a contiguous block of rows.
+    cols: string
+        One or more strings identifying the columns to be joined.
+
+    Returns
+    -------------
+    arrays: tuple
+        One array per column in ``cols`` with a NaN inserted at every sweep boundary.
+    """
+    breaks = sweep_offsets(df)[1:-1]
+
+    return(tuple(np.insert(df[c].to_numpy(dtype=float), breaks, np.nan) for c in cols))
+
 def plot_sweeps(df, x, stim, col):
     """
     This function will plot a dataframe of sweeps using plotly with hidden axis.
@@ -171,20 +322,23 @@ def plot_sweeps(df, x, stim, col):
     fig: plotly.figure
         A plotly figure object containg a pair of stacked plots of the pressure clamp stimulus and response.
     """
+    from plotly.subplots import make_subplots
+    import plotly.graph_objs as go
 
     fig = make_subplots(rows=2, cols=1,  row_width=[0.6, 0.3])
-    
-    for name, sweep in df.groupby('sweep'):
-        
-        fig.add_trace(
-            go.Scatter(mode='lines', name=name, x=sweep.loc[:, x], y=sweep.loc[:, stim], marker=dict(color='#800000'),
-                hovertemplate='x: %{x}<br>' + 'y: %{y}<br>'),
-            row=1, col=1)
-            
-        fig.add_trace(
-            go.Scatter(mode='lines', name=name, x=sweep.loc[:, x], y=sweep.loc[:, col], marker=dict(color='black'),
-                hovertemplate='x: %{x}<br>' + 'y: %{y}<br>'),
-            row=2, col=1)
+
+    # One trace per subplot; NaN breaks keep the sweeps as separate lines
+    xs, stims, cols = join_sweeps(df, x, stim, col)
+
+    fig.add_trace(
+        go.Scattergl(mode='lines', name=stim, x=xs, y=stims, marker=dict(color='#800000'),
+            hovertemplate='x: %{x}<br>' + 'y: %{y}<br>'),
+        row=1, col=1)
+
+    fig.add_trace(
+        go.Scattergl(mode='lines', name=col, x=xs, y=cols, marker=dict(color='black'),
+            hovertemplate='x: %{x}<br>' + 'y: %{y}<br>'),
+        row=2, col=1)
 
     fig.update_layout(
         height=400,
@@ -227,21 +381,31 @@ def plot_sweeps_stacked(df, x, stim, col):
     fig: plotly.figure
         A plotly figure object containg a pair of stacked plots of the pressure clamp stimulus and response.
     """
-    nsweeps = len(np.unique(df.sweep))
+    from plotly.subplots import make_subplots
+    import plotly.graph_objs as go
+
+    offsets = sweep_offsets(df)
+    sweeps = df['sweep'].to_numpy()
+    xValues, colValues = df[x].to_numpy(), df[col].to_numpy()
+    nsweeps = len(offsets) - 1
 
-    fig = make_subplots(rows=nsweeps + 1, cols=1,  row_width=[1/(nsweeps + 1) for i in range(nsweeps + 1)])
+    fig = make_subplots(rows=nsweeps + 1, cols=1)
     
-    for name, sweep in df.groupby('sweep'):
-        
-        fig.add_trace(
-            go.Scatter(mode='lines', name=name, x=sweep.loc[:, x], y=sweep.loc[:, stim], marker=dict(color='#800000'),
-                hovertemplate='x: %{x}<br>' + 'y: %{y}<br>'),
-            row=1, col=1)
-            
+    # The stimuli share the top subplot, so they are drawn as a single trace
+    xs, stims = join_sweeps(df, x, stim)
+
+    fig.add_trace(
+        go.Scattergl(mode='lines', name=stim, x=xs, y=stims, marker=dict(color='#800000'),
+            hovertemplate='x: %{x}<br>' + 'y: %{y}<br>'),
+        row=1, col=1)
+
+    for start, stop in zip(offsets[:-1], offsets[1:]):
+        name = int(sweeps[start])
+
         fig.add_trace(
-            go.Scatter(mode='lines', name=name, x=sweep.loc[:, x], y=sweep.loc[:, col], marker=dict(color='black'),
+            go.Scattergl(mode='lines', name=name, x=xValues[start:stop], y=colValues[start:stop], marker=dict(color='black'),
                 hovertemplate='x: %{x}<br>' + 'y: %{y}<br>'),
-            row= int(np.unique(sweep.sweep)) + 1, col=1)
+            row=name + 1, col=1)
 
     fig.update_layout(
         height=800,
@@ -328,6 +492,7 @@ def plot_summary(df, x, y):
     fig: plotly.figure
         A plotly figure object plotting ``x`` as a function of ``y``.
     """
+    import plotly.graph_objs as go
 
     fig = go.Figure()
     
@@ -375,8 +540,10 @@ def fit_layer(df, x, fig, fit):
     fig: plotly.figure
         A plotly figure object plotting ``x`` as a function of ``y``.
     """
+    import plotly.graph_objs as go
 
-    xfine = np.linspace(min(df.loc[:,x]),max(df.loc[:,x]), 100)
+    values = df[x].to_numpy()
+    xfine = np.linspace(values.min(), values.max(), 100)
     fig.add_trace(
     go.Scatter(mode='lines',
                name='fit', 
@@ -414,14 +581,21 @@ def frequency_histogram(df, col, nbins, ngauss = 2):
     pcov: list
         An iterable of covariance matrices for the fits.
     """
-    
-    range_x = np.max(df.loc[:, col]) - np.min(df.loc[:,col])
+    from scipy.optimize import curve_fit
+    import plotly.graph_objs as go
+
+    values = df[col].to_numpy()
+    minVal, maxVal = values.min(), values.max()
+    range_x = maxVal - minVal
     #bin_width = 2*iqr(df.i)*len(df.i)**(-1/3) ## Freedman and Diaconis method
     #nbins = round(range_x/bin_width)
     bin_width = range_x/nbins
-    [y, x]=np.histogram(df.loc[:,col], nbins, density=True)
+    [y, x]=np.histogram(values, nbins, density=True)
     test = ngauss_guesses(x, y, ngauss)
 
+    # Keep amplitudes and widths non-negative so overlapping components cannot cancel each other out
+    bounds = (np.repeat([0, -np.inf, 0], len(test[0])), np.inf)
+
     fig = go.Figure([go.Bar(x=x[0:-1]+0.5*bin_width, y=y, marker_color = "black")])
     
     fig.update_xaxes(title_text='Current (pA)')
@@ -435,8 +609,8 @@ def frequency_histogram(df, col, nbins, ngauss = 2):
         hovermode='closest')
 
     if ngauss == 3:
-        popt, pcov = curve_fit(triple_gauss_fit, x[0:-1]+0.5*bin_width, y, p0=test)
-        xfine = np.linspace(min(df.loc[:, col]), max(df.loc[:, col]), 500)
+        popt, pcov = curve_fit(triple_gauss_fit, x[0:-1]+0.5*bin_width, y, p0=np.concatenate(test), jac=triple_gauss_jac, bounds=bounds)
+        xfine = np.linspace(minVal, maxVal, 500)
 
         fig.add_trace(
             go.Scatter(mode='lines',
@@ -475,8 +649,8 @@ def frequency_histogram(df, col, nbins, ngauss = 2):
         )
 
     else:
-        popt, pcov = curve_fit(double_gauss_fit, x[0:-1]+0.5*bin_width, y, p0=test)
-        xfine = np.linspace(min(df.loc[:,col]), max(df.loc[:,col]), 500)
+        popt, pcov = curve_fit(double_gauss_fit, x[0:-1]+0.5*bin_width, y, p0=np.concatenate(test), jac=double_gauss_jac, bounds=bounds)
+        xfine = np.linspace(minVal, maxVal, 500)
 
         fig.add_trace(
             go.Scatter(mode='lines',
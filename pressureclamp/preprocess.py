@@ -1,11 +1,65 @@
+import numpy as np
+
+def sweep_offsets(df):
+    """
+    This function will find the row offsets of each sweep in a dataframe where every sweep occupies a contiguous block of rows.
+
+    Arguments
+    -------------------
+    df: dataframe
+        A pandas dataframe with a ``sweep`` column, such as one produced by ``load_file``.
+    
+    Returns
+    ------------------
+    array
+        An array of ``nSweeps + 1`` row offsets such that sweep ``k`` spans rows ``offsets[k]:offsets[k+1]``.
+    """
+
+    sweeps = df['sweep'].to_numpy()
+
+    # An empty frame has no sweeps, only the closing offset
+    if len(sweeps) == 0:
+        return np.array([0])
+
+    breaks = np.flatnonzero(sweeps[1:] != sweeps[:-1]) + 1
+
+    return np.concatenate(([0], breaks, [len(sweeps)]))
+
+def convert_units(df, factors):
+    """
+    This function will rescale several columns of the dataframe with a single fused multiplication.
+
+    Arguments
+    -------------------
+    df: dataframe
+        A pandas dataframe with the columns named in ``factors``.
+    factors: dictionary
+        A dictionary with column names as keys and the factor by which to multiply each column as values.
+    
+    Returns
+    ------------------
+    dataframe
+        A modified pandas dataframe where each column in ``factors`` has been rescaled. The rescaled columns share a common dtype wide enough for both the columns and the factors, so integer columns become floats and float32 columns mixed with float64 ones are upcast.
+    """
+
+    cols = list(factors)
+    scale = [factors[c] for c in cols]
+
+    # Promote the block so fractional factors are never truncated by an integer dtype
+    arr = df[cols].to_numpy(dtype=np.result_type(*df[cols].dtypes, *scale))
+    arr *= np.array(scale, dtype=arr.dtype)
+    df[cols] = arr
+
+    return(df)
+
 def baseline_subtract(df, col, ref, window):
     """
-    This function will baseline subtract a specified column of the dataframe based on a provided window within a reference column.
+    This function will baseline subtract a specified column of the dataframe based on a provided window within a reference column. The dataframe is modified in place, so calling it twice on the same dataframe subtracts twice.
 
     Arguments
     -------------------
     df: dataframe
-        A pandas dataframe with columns ``col`` and ``ref``.
+        A pandas dataframe with columns ``col``, ``ref`` and ``sweep``, with each sweep in a contiguous block of rows.
     col: string
         A string indicating the name of the column to be baseline subtracted.
     ref: string
@@ -16,18 +70,30 @@ def baseline_subtract(df, col, ref, window):
     Returns
     ------------------
     dataframe
-        A modified pandas dataframe where the the column ``col`` has been baseline subtracted.
+        The input dataframe, modified in place, where the column ``col`` has been baseline subtracted.
     """
 
-    iblsub = []
-    grouped = df.groupby('sweep')
-    baselines = df.query(f'{ref} >= @window[0] and {ref} < @window[1]').groupby('sweep')[col].mean()
-                
-    for name,group in grouped[col]:
-        iblsub.append(group-baselines[name])
-        
-    flatList = [item for sublist in iblsub for item in sublist]
-    
+    offsets = sweep_offsets(df)
+
+    if len(offsets) == 1:
+        return(df)
+
+    values = df[col].to_numpy()
+    refValues = df[ref].to_numpy()
+    mask = (refValues >= window[0]) & (refValues < window[1])
+
+    # Per-sweep means over the window from contiguous segment sums
+    counts = np.add.reduceat(mask, offsets[:-1])
+
+    if (counts == 0).any():
+        missing = df['sweep'].to_numpy()[offsets[:-1][counts == 0]]
+        raise Exception(f"Baseline window {list(window)} contains no rows of {ref} for sweeps {missing.tolist()}")
+
+    baselines = np.add.reduceat(np.where(mask, values, 0), offsets[:-1]) / counts
+
+    # Broadcast each sweep's baseline back onto its rows and subtract in one pass
+    df[col] = values - np.repeat(baselines, np.diff(offsets))
+
     return(df)
 
 def isolate_opening(df, sweepnum, window):
@@ -37,9 +103,9 @@ def isolate_opening(df, sweepnum, window):
     Arguments
     -------------------
     df: dataframe
-        A pandas dataframe with columns p, ti, tp, and i.
+        A pandas dataframe with columns p, ti, tp, i, and sweep where ti increases within each sweep.
     sweepnum: int
-        The 
+        The number of the sweep to isolate.
     window: iterable
         an iterable with the start and end coordinates of the baseline window.
     
@@ -49,6 +115,15 @@ def isolate_opening(df, sweepnum, window):
         A modified pandas dataframe.
     """
 
-    subsetDf = df.query('sweep == @sweepnum')
-    subsetDf = subsetDf.query('ti >= @window[0] and ti < @window[1]')
+    offsets = sweep_offsets(df)
+    match = np.flatnonzero(df['sweep'].to_numpy()[offsets[:-1]] == sweepnum)
+
+    if len(match) == 0:
+        return df.iloc[0:0]
+
+    # Time is sorted within a sweep, so the window bounds are found by binary search
+    start, stop = offsets[match[0]], offsets[match[0] + 1]
+    lo, hi = start + np.searchsorted(df['ti'].to_numpy()[start:stop], window[:2])
+
+    subsetDf = df.iloc[lo:hi]
     return subsetDf
\ No newline at end of file
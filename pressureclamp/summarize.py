@@ -1,5 +1,4 @@
 import numpy as np
-import pandas as pd
 
 def sweep_summary(df, stim, col, ref, window, param="Max"):
     """
@@ -26,41 +25,25 @@ def sweep_summary(df, stim, col, ref, window, param="Max"):
         A dataframe summarizing the desired ``col`` across sweeps over a given ``window`` on a reference column, ``ref``.
     """
 
-    subsetDf = df.query(f'{ref} >= @window[0] and {ref} < @window[1]')
-    groups = subsetDf.groupby('sweep')
+    refValues = df[ref].to_numpy()
+    subsetDf = df.loc[(refValues >= window[0]) & (refValues < window[1])]
+    groups = subsetDf.groupby('sweep', observed=True, sort=False)
 
     if param == 'None':
         return
     elif param == 'Mean':
-        iMean = groups[col].mean()
-        summaryDict = {
-            stim: np.abs(groups[stim].median()),
-            'mean_i': iMean,
-            'mean_norm_i': np.abs(iMean)/np.max(np.abs(iMean)),
-            'stdev_i': groups[col].std()
-        }
+        summaryDf = groups.agg(**{stim: (stim, 'median'), 'mean_i': (col, 'mean'), 'stdev_i': (col, 'std')})
+        summaryDf[stim] = np.abs(summaryDf[stim])
+        summaryDf.insert(2, 'mean_norm_i', np.abs(summaryDf['mean_i'])/np.max(np.abs(summaryDf['mean_i'])))
 
-        summaryDf = pd.DataFrame(summaryDict)
-
- 
     elif param == 'Max':
-        iMax = groups[col].max()
-        summaryDict = {
-            stim: np.abs(groups[stim].median()),
-            'max_i': iMax,
-            'max_norm_i': iMax/np.max(iMax)
-        }
+        summaryDf = groups.agg(**{stim: (stim, 'median'), 'max_i': (col, 'max')})
+        summaryDf[stim] = np.abs(summaryDf[stim])
+        summaryDf['max_norm_i'] = summaryDf['max_i']/np.max(summaryDf['max_i'])
 
-        summaryDf = pd.DataFrame(summaryDict)
-        
     else:
-        iMin = groups[col].min()
-        summaryDict = {
-            stim: np.abs(groups[stim].median()),
-            'min_i': iMin,
-            'min_norm_i': iMin/np.min(iMin),
-        }
+        summaryDf = groups.agg(**{stim: (stim, 'median'), 'min_i': (col, 'min')})
+        summaryDf[stim] = np.abs(summaryDf[stim])
+        summaryDf['min_norm_i'] = summaryDf['min_i']/np.min(summaryDf['min_i'])
 
-        summaryDf = pd.DataFrame(summaryDict)
-        
     return summaryDf
\ No newline at end of file